@@ -8,19 +8,24 @@ Flask app for MedicinalLeaf
 """
 
 import os
-import io
+import logging
+import queue
+import atexit
 import sqlite3
-import base64
+import threading
+import time
+from binascii import a2b_base64
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 from flask import Flask, render_template, request, redirect, url_for, jsonify, session, send_from_directory
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
-from PIL import Image
+import numpy as np
 
 # local model loader
-from model_loader import predict_image, preprocess_image_if_available
+from model_loader import load_models, predict_array, decode_image, image_to_array, save_jpeg, preprocess_image_if_available
 
 # --- Config ---
 BASE_DIR = Path(__file__).resolve().parents[1]
@@ -28,15 +33,28 @@ DB_PATH = BASE_DIR / "database" / "leaf_info.db"
 UPLOAD_FOLDER = Path(__file__).resolve().parent / "static" / "uploads"
 UPLOAD_FOLDER.mkdir(parents=True, exist_ok=True)
 ALLOWED_EXT = {".jpg", ".jpeg", ".png", ".bmp"}
+# explicit PBKDF2 cost instead of Werkzeug's moving default; existing hashes keep their own cost
+PASSWORD_HASH_METHOD = os.environ.get("MEDICINALLEAF_PASSWORD_HASH", "pbkdf2:sha256:260000")
+# comma-separated usernames allowed to use the /admin endpoints (registration is open to anyone)
+ADMIN_USERS = {u.strip() for u in os.environ.get("MEDICINALLEAF_ADMINS", "").split(",") if u.strip()}
 
 # --- Flask app setup ---
 app = Flask(__name__, static_folder="static", template_folder="templates")
 app.secret_key = os.environ.get("MEDICINALLEAF_SECRET", "replace_this_with_secure_random")
 
+# model_loader logs (rembg setup, ensemble stats) go through the app's handlers
+_loader_logger = logging.getLogger("model_loader")
+_loader_logger.setLevel(logging.INFO)
+for _handler in app.logger.handlers:
+    _loader_logger.addHandler(_handler)
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = "login"
 
+# background jobs (saving, segmentation, history) that the response does not wait for
+app_executor = ThreadPoolExecutor(max_workers=2)
+
 # --- Simple User class for Flask-Login ---
 class User(UserMixin):
     def __init__(self, uid, username):
@@ -50,12 +68,151 @@ def load_user(user_id):
     username = session.get("username")
     return User(user_id, username) if username else None
 
-# --- DB helper ---
-def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
+# --- SQL ---
+# Statements are kept as constants so sqlite3's per-connection statement cache
+# reuses the compiled form across requests.
+SQL_CREATE_USERS = "CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE, password TEXT)"
+SQL_CREATE_HISTORY = "CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT, filename TEXT, label TEXT, confidence REAL, created_at TEXT)"
+# serves the per-user history listing in order without a table scan or sort
+SQL_CREATE_HISTORY_INDEX = "CREATE INDEX IF NOT EXISTS ix_history_user_time ON history(username, created_at DESC)"
+SQL_INSERT_USER = "INSERT INTO users (username, password) VALUES (?, ?)"
+SQL_SELECT_USER = "SELECT id, password FROM users WHERE username=?"
+SQL_SELECT_HISTORY = "SELECT filename, label, confidence, created_at FROM history WHERE username=? ORDER BY created_at DESC"
+SQL_INSERT_HISTORY = "INSERT INTO history (username, filename, label, confidence, created_at) VALUES (?, ?, ?, ?, ?)"
+SQL_SELECT_ALL_LEAF_INFO = "SELECT name, scientific_name, benefits FROM LeafInfo"
+
+# --- DB helpers ---
+# per-connection settings; journal_mode=WAL is persistent and set once in init_db
+SQLITE_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=30000000",
+    "PRAGMA cache_size=-20000",
+)
+
+def connect_db():
+    # autocommit connection, tuned once when it is opened
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
     conn.row_factory = sqlite3.Row
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+_db_local = threading.local()
+
+def get_db():
+    # one long-lived connection per worker thread, reused across requests
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = _db_local.conn = connect_db()
     return conn
 
+def init_db():
+    # create app tables once at startup instead of in every request
+    conn = connect_db()
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(SQL_CREATE_USERS)
+    conn.execute(SQL_CREATE_HISTORY)
+    conn.execute(SQL_CREATE_HISTORY_INDEX)
+    conn.close()
+
+# LeafInfo is small, read-mostly reference data, so it is served from memory
+LEAF_INFO = {}
+
+def load_leaf_info():
+    global LEAF_INFO
+    conn = connect_db()
+    try:
+        rows = conn.execute(SQL_SELECT_ALL_LEAF_INFO).fetchall()
+    except sqlite3.OperationalError as e:
+        # LeafInfo is created by database/db_setup.py
+        app.logger.warning("Failed to load LeafInfo: %s", e)
+        rows = []
+    finally:
+        conn.close()
+    LEAF_INFO = {r["name"]: (r["scientific_name"], r["benefits"]) for r in rows}
+    return len(LEAF_INFO)
+
+# History rows are queued by the request path and written in batches by one
+# background thread, so there is one transaction per flush instead of per prediction.
+# The queue and thread are created lazily in the process that queues the first row:
+# under gunicorn's preload a thread started at import would live only in the master,
+# and a forked worker would inherit its stale waiter on the queue.
+HIST_BATCH_SIZE = 500
+HIST_FLUSH_INTERVAL = 0.5  # seconds
+_HIST_STOP = None  # queue sentinel
+_hist_queue = None
+_hist_thread = None
+_hist_pid = None
+_hist_lock = threading.Lock()
+
+def _collect_history_batch(hist_queue):
+    # block for the first row, then gather more until the batch is full or the interval ends
+    rows = [hist_queue.get()]
+    deadline = time.monotonic() + HIST_FLUSH_INTERVAL
+    while len(rows) < HIST_BATCH_SIZE and rows[-1] is not _HIST_STOP:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            break
+        try:
+            rows.append(hist_queue.get(timeout=timeout))
+        except queue.Empty:
+            break
+    return rows
+
+def _write_history(conn, rows):
+    conn.execute("BEGIN")
+    try:
+        conn.executemany(SQL_INSERT_HISTORY, rows)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def history_flusher(hist_queue):
+    conn = connect_db()
+    stopping = False
+    while not stopping:
+        rows = _collect_history_batch(hist_queue)
+        if rows[-1] is _HIST_STOP:
+            # write whatever is left in the queue on shutdown
+            stopping = True
+            rows.pop()
+            while True:
+                try:
+                    rows.append(hist_queue.get_nowait())
+                except queue.Empty:
+                    break
+            rows = [r for r in rows if r is not _HIST_STOP]
+        if not rows:
+            continue
+        try:
+            _write_history(conn, rows)
+        except Exception as e:
+            app.logger.warning("Failed to save %d history rows: %s", len(rows), e)
+    conn.close()
+
+def queue_history(row):
+    global _hist_queue, _hist_thread, _hist_pid
+    if _hist_pid != os.getpid():
+        with _hist_lock:
+            if _hist_pid != os.getpid():
+                _hist_queue = queue.Queue()
+                _hist_thread = threading.Thread(target=history_flusher, args=(_hist_queue,),
+                                                name="history-flusher", daemon=True)
+                _hist_thread.start()
+                _hist_pid = os.getpid()
+    _hist_queue.put(row)
+
+@atexit.register
+def stop_history_flusher():
+    if _hist_pid == os.getpid() and _hist_thread.is_alive():
+        _hist_queue.put(_HIST_STOP)
+        _hist_thread.join(timeout=5)
+
+init_db()
+load_leaf_info()
+
 # --- Routes ---
 @app.route("/")
 def home():
@@ -70,17 +227,13 @@ def register():
         password = request.form.get("password")
         if not username or not password:
             return "Username and password required", 400
-        hashed = generate_password_hash(password)
-        conn = get_db_connection()
+        hashed = generate_password_hash(password, method=PASSWORD_HASH_METHOD, salt_length=16)
+        conn = get_db()
         cur = conn.cursor()
-        cur.execute("CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE, password TEXT)")
         try:
-            cur.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, hashed))
-            conn.commit()
+            cur.execute(SQL_INSERT_USER, (username, hashed))
         except sqlite3.IntegrityError:
-            conn.close()
             return "Username already exists", 400
-        conn.close()
         return redirect(url_for("login"))
     return render_template("register.html")
 
@@ -89,11 +242,10 @@ def login():
     if request.method == "POST":
         username = request.form.get("username").strip()
         password = request.form.get("password").strip()
-        conn = get_db_connection()
+        conn = get_db()
         cur = conn.cursor()
-        cur.execute("SELECT id, password FROM users WHERE username=?", (username,))
+        cur.execute(SQL_SELECT_USER, (username,))
         row = cur.fetchone()
-        conn.close()
         if row and check_password_hash(row["password"], password):
             user = User(row["id"], username)
             login_user(user)
@@ -117,14 +269,22 @@ def dashboard():
 @app.route("/history")
 @login_required
 def history():
-    conn = get_db_connection()
+    conn = get_db()
     cur = conn.cursor()
-    cur.execute("CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT, filename TEXT, label TEXT, confidence REAL, created_at TEXT)")
-    cur.execute("SELECT filename, label, confidence, created_at FROM history WHERE username=? ORDER BY created_at DESC", (current_user.username,))
+    cur.execute(SQL_SELECT_HISTORY, (current_user.username,))
     rows = cur.fetchall()
-    conn.close()
     return render_template("history.html", rows=rows)
 
+# Re-read LeafInfo after the table has been edited. Each process keeps its own copy, so
+# under gunicorn this only refreshes the worker that serves the request; send HUP to the
+# gunicorn master instead, which replaces every worker and each reloads on start.
+@app.route("/admin/reload", methods=["POST"])
+@login_required
+def admin_reload():
+    if current_user.username not in ADMIN_USERS:
+        return jsonify({"error": "Admin only"}), 403
+    return jsonify({"leaf_info": load_leaf_info(), "pid": os.getpid()})
+
 # allow serving user-uploaded images
 @app.route("/uploads/<path:filename>")
 @login_required
@@ -136,6 +296,40 @@ def allowed_file(filename):
     ext = Path(filename).suffix.lower()
     return ext in ALLOWED_EXT
 
+# look up scientific name and benefits for a predicted label
+def get_leaf_info(label):
+    return LEAF_INFO.get(label, ("N/A", "N/A"))
+
+# Background jobs: write the image (segmented for display if possible) and save to history.
+# The prediction has already been returned, so the history row keeps that label.
+def store_upload(save_path, file_bytes):
+    save_path.write_bytes(file_bytes)
+    # Optional preprocessing step (segmentation) if available
+    try:
+        preprocess_image_if_available(str(save_path))
+    except Exception as e:
+        app.logger.warning("Preprocess failed: %s", e)
+
+def store_frame(save_path, img):
+    # webcam frames are segmented in memory and encoded once
+    with img:
+        arr = np.asarray(img)
+    try:
+        processed = preprocess_image_if_available(arr)
+        if processed is not None:
+            arr = processed[..., :3]  # JPEG has no alpha channel
+    except Exception as e:
+        app.logger.warning("Preprocess failed: %s", e)
+    save_jpeg(arr, save_path)
+
+def record_prediction(username, save_name, label, confidence, store_image, data):
+    try:
+        store_image(UPLOAD_FOLDER / save_name, data)
+    except Exception as e:
+        app.logger.warning("Failed to save image: %s", e)
+        return
+    queue_history((username, save_name, label, float(confidence), datetime.utcnow().isoformat()))
+
 # Upload file endpoint
 @app.route("/upload", methods=["POST"])
 @login_required
@@ -151,46 +345,24 @@ def upload():
     filename = secure_filename(file.filename)
     timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
     save_name = f"{current_user.username}_{timestamp}_{filename}"
-    save_path = UPLOAD_FOLDER / save_name
-    file.save(save_path)
+    file_bytes = file.read()
 
-    # Optional preprocessing step (segmentation) if available
     try:
-        preprocess_image_if_available(str(save_path))
+        with decode_image(file_bytes) as img:
+            x = image_to_array(img)
     except Exception as e:
-        # don't fail if preprocessing not available or fails — continue to prediction
-        app.logger.warning("Preprocess failed: %s", e)
+        return jsonify({"error": f"Invalid image data: {e}"}), 400
 
     # Predict
     try:
-        label, confidence = predict_image(str(save_path))
+        label, confidence = predict_array(x)
     except Exception as e:
         return jsonify({"error": f"Prediction error: {e}"}), 500
 
-    # retrieve info from DB
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT scientific_name, benefits FROM LeafInfo WHERE name=?", (label,))
-    info = cur.fetchone()
-    conn.close()
-    if info:
-        scientific_name = info["scientific_name"]
-        benefits = info["benefits"]
-    else:
-        scientific_name = "N/A"
-        benefits = "N/A"
-
-    # save to history
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT, filename TEXT, label TEXT, confidence REAL, created_at TEXT)")
-        cur.execute("INSERT INTO history (username, filename, label, confidence, created_at) VALUES (?, ?, ?, ?, ?)",
-                    (current_user.username, save_name, label, float(confidence), datetime.utcnow().isoformat()))
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        app.logger.warning("Failed to save history: %s", e)
+    scientific_name, benefits = get_leaf_info(label)
+
+    app_executor.submit(record_prediction, current_user.username, save_name, label, confidence,
+                        store_upload, file_bytes)
 
     return jsonify({
         "label": label,
@@ -209,49 +381,31 @@ def predict_base64():
     if "," in img_b64:
         header, img_b64 = img_b64.split(",", 1)
     try:
-        img_bytes = base64.b64decode(img_b64)
-        img = Image.open(io.BytesIO(img_bytes)).convert("RGB")
+        img_bytes = a2b_base64(img_b64)
+        img = decode_image(img_bytes)
     except Exception as e:
         return jsonify({"error": f"Invalid image data: {e}"}), 400
 
-    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-    save_name = f"{current_user.username}_cam_{timestamp}.jpg"
-    save_path = UPLOAD_FOLDER / save_name
-    img.save(save_path)
-
-    # Optional preprocessing
+    # predict straight from memory, the saved copy is only used for history display
     try:
-        preprocess_image_if_available(str(save_path))
-    except Exception as e:
-        app.logger.warning("Preprocess failed: %s", e)
-
-    try:
-        label, confidence = predict_image(str(save_path))
+        x = image_to_array(img)
+        label, confidence = predict_array(x)
     except Exception as e:
+        img.close()
         return jsonify({"error": f"Prediction error: {e}"}), 500
 
-    # fetch leaf info
-    conn = get_db_connection(); cur = conn.cursor()
-    cur.execute("SELECT scientific_name, benefits FROM LeafInfo WHERE name=?", (label,))
-    info = cur.fetchone()
-    conn.close()
-    if info:
-        scientific_name = info["scientific_name"]
-        benefits = info["benefits"]
-    else:
-        scientific_name = "N/A"
-        benefits = "N/A"
-
-    # save history
-    try:
-        conn = get_db_connection(); cur = conn.cursor()
-        cur.execute("INSERT INTO history (username, filename, label, confidence, created_at) VALUES (?, ?, ?, ?, ?)",
-                    (current_user.username, save_name, label, float(confidence), datetime.utcnow().isoformat()))
-        conn.commit(); conn.close()
-    except Exception as e:
-        app.logger.warning("Failed to save history: %s", e)
+    scientific_name, benefits = get_leaf_info(label)
+
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    save_name = f"{current_user.username}_cam_{timestamp}.jpg"
+    # the background job owns (and closes) the decoded frame from here on
+    app_executor.submit(record_prediction, current_user.username, save_name, label, confidence,
+                        store_frame, img)
 
     return jsonify({"label": label, "confidence": float(confidence), "info": {"scientific_name": scientific_name, "benefits": benefits}})
 
+# Development server only; production runs under gunicorn (see gunicorn.conf.py).
+# The reloader re-imports the models on every change, so debug is opt-in.
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0", port=5000)
+    load_models()
+    app.run(debug=os.environ.get("FLASK_DEBUG") == "1", host="0.0.0.0", port=5000)
@@ -0,0 +1,70 @@
+"""
+Build-time conversion of the Keras .h5 models to INT8 TFLite.
+
+Uses post-training quantization with a representative dataset of sample leaves
+taken from dataset/<class>/*. Run once after training:
+
+    python app/convert_tflite.py
+
+model_loader.py picks up the *_int8.tflite files automatically.
+"""
+
+import os
+import sys
+import tensorflow as tf
+from PIL import Image
+from tensorflow.keras.models import load_model
+
+# model_loader only loads models in load_models(), so importing it here is cheap
+from model_loader import PROJECT_ROOT, EFF_MODEL, RES_MODEL, EFF_TFLITE, RES_TFLITE, image_to_array
+
+DATASET_DIR = os.path.join(PROJECT_ROOT, "dataset")
+NUM_SAMPLES = 100
+IMAGE_EXT = (".jpg", ".jpeg", ".png", ".bmp")
+
+def sample_images(limit=NUM_SAMPLES):
+    """
+    Collect up to `limit` image paths, round-robin over class folders so every class is represented.
+    """
+    per_class = []
+    for root, _, files in sorted(os.walk(DATASET_DIR)):
+        imgs = [os.path.join(root, f) for f in sorted(files) if f.lower().endswith(IMAGE_EXT)]
+        if imgs:
+            per_class.append(imgs)
+    paths = []
+    i = 0
+    while len(paths) < limit and any(i < len(c) for c in per_class):
+        paths.extend(c[i] for c in per_class if i < len(c))
+        i += 1
+    return paths[:limit]
+
+def representative_dataset(paths):
+    # calibrate on exactly the pixels served at inference time (Pillow BILINEAR resize, /255)
+    def gen():
+        for p in paths:
+            with Image.open(p) as raw:
+                img = raw.convert("RGB")
+            with img:
+                # image_to_array reuses one buffer, so hand the converter a copy
+                yield [image_to_array(img).copy()]
+    return gen
+
+def convert(h5_path, tflite_path, paths):
+    model = load_model(h5_path)
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset(paths)
+    with open(tflite_path, "wb") as f:
+        f.write(converter.convert())
+    print("Wrote", tflite_path)
+
+if __name__ == "__main__":
+    paths = sample_images()
+    if not paths:
+        sys.exit(f"No sample images found under {DATASET_DIR}")
+    print("Using", len(paths), "representative images")
+    for h5_path, tflite_path in ((EFF_MODEL, EFF_TFLITE), (RES_MODEL, RES_TFLITE)):
+        if os.path.exists(h5_path):
+            convert(h5_path, tflite_path, paths)
+        else:
+            print("Skipping missing model:", h5_path)
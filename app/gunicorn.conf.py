@@ -0,0 +1,27 @@
+"""
+Gunicorn settings for serving MedicinalLeaf in production:
+
+    cd app && gunicorn -c gunicorn.conf.py app:app
+
+The app code is imported once in the master and the workers are forked from it.
+The models are not: TensorFlow and the TFLite/XNNPACK thread pools do not survive
+a fork, so each worker loads and warms up its own copy in post_worker_init. The
+quantized .tflite files are mmapped, so workers still share those pages.
+"""
+
+import os
+
+bind = os.environ.get("MEDICINALLEAF_BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", 4))
+worker_class = "gthread"
+threads = 2
+preload_app = True
+
+def post_worker_init(worker):
+    # split the cores between workers instead of every model using all of them
+    from model_loader import load_models
+    # worker.cfg.workers is the count actually in use, including a -w override
+    load_models(num_threads=max(1, (os.cpu_count() or 1) // worker.cfg.workers))
+    # the preloaded LeafInfo copy may be stale after a HUP, so read it again
+    from app import load_leaf_info
+    load_leaf_info()
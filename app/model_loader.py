@@ -1,9 +1,25 @@
 import os
+import io
+import math
 import json
+import time
+import logging
+import threading
 import numpy as np
+from PIL import Image
 
+logger = logging.getLogger(__name__)
+
+# fast-math for the XLA-compiled Keras runners; must be set before TensorFlow is imported
+os.environ.setdefault("XLA_FLAGS", "--xla_cpu_enable_fast_math=true")
+
+import tensorflow as tf
 from tensorflow.keras.models import load_model
-from tensorflow.keras.preprocessing import image
+
+# oneDNN bfloat16 auto mixed precision for graphs run by TensorFlow itself. The Keras
+# runners are compiled whole by XLA (jit_compile), which does not apply this rewrite,
+# so their softmax matches float32 and CASCADE_THRESHOLD needs no re-calibration.
+tf.config.optimizer.set_experimental_options({"auto_mixed_precision_onednn_bfloat16": True})
 
 # Where models are expected (top-level of project)
 PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
@@ -12,14 +28,87 @@ MODELS_DIR = os.path.join(PROJECT_ROOT, "models")
 EFF_MODEL = os.path.join(MODELS_DIR, "efficientnet_b0_model.h5")
 RES_MODEL = os.path.join(MODELS_DIR, "resnet50_model.h5")
 
-_models = []
-for p in (EFF_MODEL, RES_MODEL):
-    if os.path.exists(p):
+# INT8 versions produced by convert_tflite.py; preferred over the .h5 files when present
+EFF_TFLITE = os.path.splitext(EFF_MODEL)[0] + "_int8.tflite"
+RES_TFLITE = os.path.splitext(RES_MODEL)[0] + "_int8.tflite"
+
+INPUT_SPEC = tf.TensorSpec([None, 224, 224, 3], tf.float32)
+
+def _tflite_runner(path, num_threads):
+    """
+    Load a TFLite model and return a callable float32[1,224,224,3] -> softmax vector.
+    The model file is mmapped, so workers loading the same file share its pages.
+    """
+    interp = tf.lite.Interpreter(model_path=path, num_threads=num_threads)
+    interp.allocate_tensors()
+    in_idx = interp.get_input_details()[0]["index"]
+    out_idx = interp.get_output_details()[0]["index"]
+    # an interpreter is not thread-safe, so its invocations are serialized
+    lock = threading.Lock()
+
+    def run(x):
+        with lock:
+            interp.set_tensor(in_idx, x)
+            interp.invoke()
+            return interp.get_tensor(out_idx)[0]
+    return run
+
+def _keras_runner(path, num_threads):
+    """
+    Load a Keras model, trace it once into an XLA-compiled concrete function and run it on a
+    zero tensor so compilation happens before the first request. Returns a callable like _tflite_runner.
+    """
+    m = load_model(path)
+    concrete = tf.function(lambda t: m(t, training=False), jit_compile=True).get_concrete_function(INPUT_SPEC)
+    concrete(tf.zeros([1, 224, 224, 3], tf.float32))
+    return lambda x: concrete(tf.constant(x)).numpy()[0]
+
+# Models are loaded by load_models(), not at import: TensorFlow and the TFLite thread
+# pools must not be started before a fork, so under gunicorn each worker loads its own
+# (see gunicorn.conf.py). predict_array loads them on first use if nobody did.
+_runners = None
+_runners_lock = threading.Lock()
+
+def load_models(num_threads=None):
+    """
+    Load and warm up the ensemble in the current process. num_threads caps the CPU threads
+    each model uses (default: all cores); pass cores // workers when running several workers.
+    Returns the number of models loaded.
+    """
+    global _runners
+    with _runners_lock:
+        if _runners is not None:
+            return len(_runners)
+        num_threads = num_threads or os.cpu_count()
         try:
-            _models.append(load_model(p))
-            print("Loaded model:", os.path.basename(p))
-        except Exception as e:
-            print("Failed to load", p, ":", e)
+            tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+            tf.config.threading.set_inter_op_parallelism_threads(num_threads)
+        except RuntimeError as e:
+            # the TF runtime was already started in this process
+            logger.warning("Could not limit TensorFlow threads: %s", e)
+
+        # Ordered cheap -> expensive, which the confidence cascade in predict_array relies on.
+        # Each model uses its quantized version when present, else the Keras .h5.
+        runners = []
+        for tflite_path, h5_path in ((EFF_TFLITE, EFF_MODEL), (RES_TFLITE, RES_MODEL)):
+            for p, load in ((tflite_path, _tflite_runner), (h5_path, _keras_runner)):
+                if os.path.exists(p):
+                    try:
+                        runners.append(load(p, num_threads))
+                        print("Loaded model:", os.path.basename(p))
+                        break
+                    except Exception as e:
+                        print("Failed to load", p, ":", e)
+        _runners = runners
+        return len(_runners)
+
+# If the first model is at least this confident, the rest of the ensemble is skipped.
+# Calibrate against a held-out set. Each process counts how often the early exit is taken
+# and logs the hit rate every CASCADE_LOG_EVERY ensemble predictions (0 or less: never).
+CASCADE_THRESHOLD = float(os.environ.get("MEDICINALLEAF_CASCADE_THRESHOLD", "0.9"))
+CASCADE_LOG_EVERY = int(os.environ.get("MEDICINALLEAF_CASCADE_LOG_EVERY", "500"))
+CASCADE_STATS = {"early_exit": 0, "full": 0}
+_stats_lock = threading.Lock()
 
 # class mapping (optional)
 CLASS_MAP = {}
@@ -33,75 +122,217 @@ if os.path.exists(class_map_file):
     except Exception as e:
         print("Failed to load class_indices.json:", e)
 
-# --- Prediction function ---
-def predict_image(img_path):
+# class index -> class name, built once for predict_array
+INV_CLASS_MAP = {v: k for k, v in CLASS_MAP.items()}
+
+# --- Prediction functions ---
+def predict_array(x):
     """
-    Predict using ensemble of loaded models.
+    Predict using ensemble of loaded models on an already preprocessed float32[1,224,224,3] tensor.
+    The remaining models only run when the first one is below CASCADE_THRESHOLD.
     Returns (label, confidence) where label is class name if class indices provided else index str.
     """
-    if not _models:
+    if _runners is None:
+        load_models()
+    if not _runners:
         raise RuntimeError("No models loaded in 'models/' directory. Add your .h5 files.")
 
-    img = image.load_img(img_path, target_size=(224, 224))
-    x = image.img_to_array(img).astype("float32") / 255.0
-    x = np.expand_dims(x, axis=0)
+    avg = _runners[0](x)
+    if len(_runners) > 1:
+        early_exit = float(np.max(avg)) >= CASCADE_THRESHOLD
+        if not early_exit:
+            avg = np.mean([avg] + [run(x) for run in _runners[1:]], axis=0)
+        with _stats_lock:
+            CASCADE_STATS["early_exit" if early_exit else "full"] += 1
+            exits = CASCADE_STATS["early_exit"]
+            total = exits + CASCADE_STATS["full"]
+        if CASCADE_LOG_EVERY > 0 and total % CASCADE_LOG_EVERY == 0:
+            logger.info("Cascade early exit %d/%d (%.1f%%) at threshold %.2f [pid %d]",
+                        exits, total, 100.0 * exits / total, CASCADE_THRESHOLD, os.getpid())
 
-    preds = []
-    for m in _models:
-        try:
-            p = m.predict(x)
-            preds.append(p[0])
-        except Exception as e:
-            print("Model prediction error:", e)
-    if not preds:
-        raise RuntimeError("No predictions produced by models.")
-
-    avg = np.mean(preds, axis=0)
     idx = int(np.argmax(avg))
     confidence = float(np.max(avg))
 
     # map to class name if CLASS_MAP exists
-    if CLASS_MAP:
-        inv = {v: k for k, v in CLASS_MAP.items()}
-        label = inv.get(idx, str(idx))
-    else:
-        label = str(idx)
+    label = INV_CLASS_MAP.get(idx, str(idx))
     return label, confidence
 
+# per-thread scratch: the model input buffer filled by image_to_array
+_tls = threading.local()
+
+# libjpeg-turbo (PyTurboJPEG) is optional; Pillow handles JPEG when it is missing
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _tj = TurboJPEG()
+except Exception as e:
+    logger.warning("turbojpeg not available, using Pillow for JPEG: %s", e)
+    _tj = None
+
+JPEG_QUALITY = 80
+
+def decode_image(img_bytes):
+    """
+    Decode encoded image bytes into an RGB PIL image. The caller owns (and closes) the result.
+    JPEG goes through libjpeg-turbo when available, everything else through Pillow.
+    """
+    if _tj is not None and img_bytes[:2] == b"\xff\xd8":
+        try:
+            return Image.fromarray(_tj.decode(img_bytes, pixel_format=TJPF_RGB))
+        except Exception:
+            pass  # let Pillow try (and report) instead
+    with Image.open(io.BytesIO(img_bytes)) as raw:
+        return raw.convert("RGB")
+
+def save_jpeg(arr, path):
+    """
+    Encode an RGB uint8 array as JPEG to path.
+    """
+    if _tj is not None:
+        data = _tj.encode(np.ascontiguousarray(arr), quality=JPEG_QUALITY, pixel_format=TJPF_RGB)
+        with open(path, "wb") as f:
+            f.write(data)
+    else:
+        with Image.fromarray(arr) as img:
+            img.save(path, "JPEG", quality=JPEG_QUALITY)
+
+def image_to_array(img):
+    """
+    Resize an RGB PIL image to the model input and return it as float32[1,224,224,3] in [0, 1].
+    reducing_gap first shrinks large camera images with a fast box reduce before the bilinear pass.
+    The returned array is a per-thread buffer that the next call on the same thread overwrites.
+    """
+    x = getattr(_tls, "input", None)
+    if x is None:
+        x = _tls.input = np.empty((1, 224, 224, 3), np.float32)
+    with img.resize((224, 224), Image.BILINEAR, reducing_gap=3) as small:
+        np.divide(np.asarray(small), 255.0, out=x[0])
+    return x
+
+def predict_image(img_path):
+    """
+    Load an image file and predict it with predict_array.
+    """
+    with Image.open(img_path) as raw:
+        img = raw.convert("RGB")
+    with img:
+        x = image_to_array(img)
+    return predict_array(x)
+
 # --- Optional preprocessing helper (segmentation) ---
-def preprocess_image_if_available(img_path):
+# rembg is imported once here, never per request. Its ONNX session (which downloads
+# the model on first use) is created lazily by the background jobs, not at startup.
+try:
+    from rembg import remove as _rembg_remove, new_session
+except Exception as e:
+    logger.warning("rembg not available, using OpenCV fallback: %s", e)
+    _rembg_remove = None
+
+REMBG_RETRY_SECONDS = 60
+_rembg_session = None
+_rembg_retry_at = 0.0
+_rembg_lock = threading.Lock()
+
+def _get_rembg_session():
     """
-    Try to remove background if rembg installed, else do a simple contour crop via OpenCV.
-    This modifies the image file in-place (overwrites).
+    Return the shared u2netp session, creating it on first use. A failed attempt
+    (e.g. offline) is logged and retried after REMBG_RETRY_SECONDS; None means use OpenCV.
+    """
+    global _rembg_session, _rembg_retry_at
+    if _rembg_remove is None:
+        return None
+    if _rembg_session is None and time.monotonic() >= _rembg_retry_at:
+        with _rembg_lock:
+            if _rembg_session is None and time.monotonic() >= _rembg_retry_at:
+                try:
+                    _rembg_session = new_session("u2netp")
+                except Exception as e:
+                    _rembg_retry_at = time.monotonic() + REMBG_RETRY_SECONDS
+                    logger.warning("rembg session setup failed, using OpenCV fallback: %s", e)
+    return _rembg_session
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+# side of the downscaled copy the OpenCV fallback segments on
+SEGMENT_SIZE = 512
+
+def _contour_crop(img, color_to_gray):
     """
+    OpenCV fallback: crop a uint8 image to its largest Otsu contour, resized to 224x224.
+    The contour is found on a copy with each side capped at SEGMENT_SIZE and its box mapped
+    back to the full image. Returns None if nothing was found.
+    """
+    img_h, img_w = img.shape[:2]
+    small_w, small_h = min(img_w, SEGMENT_SIZE), min(img_h, SEGMENT_SIZE)
+    if (small_w, small_h) != (img_w, img_h):
+        small = cv2.resize(img, (small_w, small_h), interpolation=cv2.INTER_AREA)
+    else:
+        small = img
+    scale_x = img_w / float(small.shape[1])
+    scale_y = img_h / float(small.shape[0])
+
+    gray = cv2.cvtColor(small, color_to_gray)
+    blur = cv2.GaussianBlur(gray, (5,5), 0)
+    _, th = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    contours, _ = cv2.findContours(th, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return None
+    c = max(contours, key=cv2.contourArea)
+    x,y,w,h = cv2.boundingRect(c)
+    # round the box outwards and keep at least one pixel on each side
+    x0 = min(img_w - 1, math.floor(x * scale_x))
+    y0 = min(img_h - 1, math.floor(y * scale_y))
+    x1 = min(img_w, max(x0 + 1, math.ceil((x + w) * scale_x)))
+    y1 = min(img_h, max(y0 + 1, math.ceil((y + h) * scale_y)))
+    return cv2.resize(img[y0:y1, x0:x1], (224,224))
+
+def _preprocess_file(img_path):
     try:
         # try rembg first
-        from rembg import remove
+        session = _get_rembg_session()
+        if session is None:
+            raise RuntimeError("rembg not available")
         with open(img_path, "rb") as i:
             input_bytes = i.read()
-        output = remove(input_bytes)
+        output = _rembg_remove(input_bytes, session=session)
         with open(img_path, "wb") as o:
             o.write(output)
         return True
     except Exception:
         # fallback: OpenCV contour crop
         try:
-            import cv2
-            import numpy as np
             img = cv2.imread(img_path)
             if img is None:
                 return False
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            blur = cv2.GaussianBlur(gray, (5,5), 0)
-            _, th = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-            contours, _ = cv2.findContours(th, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            if not contours:
+            crop = _contour_crop(img, cv2.COLOR_BGR2GRAY)
+            if crop is None:
                 return False
-            c = max(contours, key=cv2.contourArea)
-            x,y,w,h = cv2.boundingRect(c)
-            crop = img[y:y+h, x:x+w]
-            crop = cv2.resize(crop, (224,224))
             cv2.imwrite(img_path, crop)
             return True
         except Exception:
             return False
+
+def _preprocess_array(arr):
+    try:
+        session = _get_rembg_session()
+        if session is None:
+            raise RuntimeError("rembg not available")
+        return _rembg_remove(arr, session=session)
+    except Exception:
+        try:
+            return _contour_crop(arr, cv2.COLOR_RGB2GRAY)
+        except Exception:
+            return None
+
+def preprocess_image_if_available(arr_or_path):
+    """
+    Try to remove background if rembg installed, else do a simple contour crop via OpenCV.
+    Given a path, the image file is modified in-place (overwritten) and True/False is returned.
+    Given an RGB uint8 array, everything stays in memory: the processed array is returned
+    (RGBA from rembg, 224x224 RGB from the OpenCV crop) or None if both failed.
+    """
+    if isinstance(arr_or_path, np.ndarray):
+        return _preprocess_array(arr_or_path)
+    return _preprocess_file(arr_or_path)
@@ -18,6 +18,20 @@ CREATE TABLE IF NOT EXISTS LeafInfo (
 )
 """)
 
+# Prediction history (also created by the app on startup)
+c.execute("""
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT,
+    filename TEXT,
+    label TEXT,
+    confidence REAL,
+    created_at TEXT
+)
+""")
+# /history lists one user's rows newest first; users.username is UNIQUE and already indexed
+c.execute("CREATE INDEX IF NOT EXISTS ix_history_user_time ON history(username, created_at DESC)")
+
 # Sample records (edit as needed)
 samples = [
     ("Neem", "Azadirachta indica", "Antibacterial, skin healing, anti-inflammatory", "Avoid ingestion in large amounts."),